@@ -42,6 +42,7 @@ def feature_loss(
     norm_weights: Optional[str] = "elements",
     scaled: bool = True,
 ):
+    input, target = input.float(), target.float()  # reduced precision targets/features are compared in FP32
     if scaled:
         loss = scaled_mse_loss(input, target)
         loss /= normalize_weights(input, norm_weights)
@@ -75,7 +76,9 @@ def gram_matrix(x, shift_x=0, shift_y=0, shift_t=0, flip_h=False, flip_v=False,
         x_flat = x_flat - x_flat.mean(1).unsqueeze(1)
         y_flat = y_flat - y_flat.mean(1).unsqueeze(1)
 
-    return x_flat @ y_flat.T
+    # summed over H*W pixels the entries easily exceed the FP16 range, so the product is always taken in FP32
+    with torch.autocast(x.device.type, enabled=False):
+        return x_flat.float() @ y_flat.float().T
 
 
 def spherical_dist_loss(x, y):
@@ -85,10 +88,12 @@ def spherical_dist_loss(x, y):
 
 
 def tv_loss(input):
-    input = F.pad(input, (0, 1, 0, 1), "replicate")
-    x_diff = input[..., :-1, 1:] - input[..., :-1, :-1]
-    y_diff = input[..., 1:, :-1] - input[..., :-1, :-1]
-    return (x_diff ** 2 + y_diff ** 2).mean([1, 2, 3]).squeeze()
+    # equivalent to replicate-padding the edges (which contributes zero differences) without copying the whole input
+    x_diff = input[..., :, 1:] - input[..., :, :-1]
+    y_diff = input[..., 1:, :] - input[..., :-1, :]
+    # the sums are taken before dividing, so reduced precision inputs are accumulated in FP32
+    x_diff, y_diff = x_diff.float(), y_diff.float()
+    return (x_diff.pow(2).sum([1, 2, 3]) + y_diff.pow(2).sum([1, 2, 3])).div(input[0].numel()).squeeze()
 
 
 def range_loss(input):
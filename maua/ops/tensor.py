@@ -43,11 +43,13 @@ def tensor2bytes(tensor: torch.Tensor) -> np.ndarray:
     """Converts a PyTorch [1,C,H,W] tensor to bytes (e.g. for passing to FFMPEG)
 
     Args:
-        tensor (torch.Tensor): Image tensor to convert to UINT8 bytes
+        tensor (torch.Tensor): Image tensor to convert to UINT8 bytes, UINT8 tensors are assumed to be quantized already
 
     Returns:
         np.ndarray
     """
+    if tensor.dtype == torch.uint8:
+        return tensor.squeeze(0).permute(1, 2, 0).cpu().numpy().tobytes()
     return tensor.squeeze(0).permute(1, 2, 0).clamp(0, 1).mul(255).round().byte().detach().cpu().numpy().tobytes()
 
 
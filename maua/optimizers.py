@@ -49,14 +49,17 @@ optimizer_choices = {
 OPTIMIZERS = list(optimizer_choices.keys()) + ["LBFGS"]
 
 
-def load_optimizer(name, lr, kwargs, n_iters, params):
+def load_optimizer(name, lr, kwargs, n_iters, params, history_size=10, max_iter=4):
     if name == "LBFGS":
         if kwargs == {}:
             kwargs = dict(tolerance_grad=-1, tolerance_change=-1)
-        return optim.LBFGS(params, lr=lr, max_iter=n_iters, **kwargs), 1
+        # many short steps rather than one long one bounds the closure re-evaluations per step
+        kwargs = {"history_size": history_size, "max_iter": max_iter, **kwargs}
+        return optim.LBFGS(params, lr=lr, **kwargs), max(n_iters // kwargs["max_iter"], 1)
 
     if "LBFGS-" in name:
         max_iter = int(name.split("-")[1])
+        kwargs = {"history_size": history_size, **kwargs}
         return optim.LBFGS(params, lr=lr, max_iter=max_iter, **kwargs), n_iters // max_iter
 
     if name in optimizer_choices:
@@ -75,7 +78,9 @@ def load_optimizer(name, lr, kwargs, n_iters, params):
         else:
             k = 0.5
 
-        return timm_optim.Lookahead(load_optimizer(name.split("-")[-1], lr, kwargs, n_iters, params), alpha, k)
+        return timm_optim.Lookahead(
+            load_optimizer(name.split("-")[-1], lr, kwargs, n_iters, params, history_size, max_iter), alpha, k
+        )
 
     raise Exception(
         f"Optimizer {name} not recognized! Choices are: {['LBFGS', 'LBFGS20'] + list(optimizer_choices.keys())}"
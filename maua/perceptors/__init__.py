@@ -2,7 +2,7 @@ from functools import partial
 
 import torch
 import torch.nn as nn
-from maua.ops.loss import feature_loss, gram_matrix
+from maua.ops.loss import feature_loss, gram_matrix, tv_loss
 from nestedtensor import nested_tensor
 
 
@@ -15,6 +15,7 @@ class Perceptor(nn.Module):
         self.embeddings = [None for _ in content_layers + style_layers]
         self.targets = None
         self.loss = 0
+        self.gram_norm = 1  # Grams are divided by this and their (linear) loss multiplied, results don't change
 
     def register_layer_hooks(self):
         for c, layer in enumerate(self.content_layers):
@@ -31,11 +32,11 @@ class Perceptor(nn.Module):
         for s, layer in enumerate(self.style_layers):
 
             def style_hook(module, input, output, l=c + 1 + s):
-                embedding = gram_matrix(output)
+                embedding = gram_matrix(output) / self.gram_norm
                 if self.targets is None:
                     self.embeddings[l] = embedding
                 else:
-                    self.loss += self.style_strength * feature_loss(embedding, self.targets[l])
+                    self.loss += self.style_strength * self.gram_norm * feature_loss(embedding, self.targets[l])
 
             getattr(self.net, str(layer)).register_forward_hook(style_hook)
 
@@ -78,15 +79,17 @@ class Perceptor(nn.Module):
 
     def forward(self, x):
         self.net(self.preprocess(x))
-        return nested_tensor(self.embeddings, device=x.device)
+        # Gram matrices are FP32 while reduced precision features are not, a nested tensor needs a single dtype
+        return nested_tensor([embedding.float() for embedding in self.embeddings], device=x.device)
 
-    def get_loss(self, x, targets):
+    def get_loss(self, x, targets, tv_weight=0):
         assert len(targets) == len(
             self.embeddings
         ), f"The target embeddings don't match this perceptor's embeddings: {len(targets)}. Expected: {len(self.embeddings)}"
-        self.loss = 0
+        # total variation is computed first, while x is still hot in cache, rather than re-reading it after the network
+        self.loss = tv_weight * tv_loss(x) if tv_weight > 0 else 0
         self.targets = targets
-        self.forward(x)
+        self.net(self.preprocess(x))  # the hooks accumulate the loss, no need to collect embeddings
         self.targets = None
         return self.loss
 
@@ -38,7 +38,7 @@ class PGGPerceptor(Perceptor):
 
         # convert to BGR and scale to range Caffe VGGs expect
         mean_pixel = torch.tensor([103.939, 116.779, 123.68]) / 255
-        self.preprocess = lambda x: 255 * (x[:, [2, 1, 0]] - mean_pixel.to(x.device).reshape(1, 3, 1, 1))
+        self.preprocess = lambda x: 255 * (x[:, [2, 1, 0]] - mean_pixel.to(x.device, x.dtype).reshape(1, 3, 1, 1))
 
         self.register_layer_hooks()
 
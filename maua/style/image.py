@@ -3,6 +3,9 @@ Neural style transfer
 """
 
 import gc
+import math
+import warnings
+from contextlib import nullcontext
 from pathlib import Path
 from typing import List, Union
 
@@ -12,14 +15,41 @@ from torch import Tensor
 from tqdm import tqdm
 
 from maua.ops.image import match_histogram, resample
-from maua.ops.loss import tv_loss
 from maua.ops.tensor import load_images, tensor2img
 from maua.optimizers import load_optimizer, OPTIMIZERS
 from maua.parameterizations import load_parameterization
 from maua.perceptors import load_perceptor
+from maua.utility import enable_expandable_segments, parse_kwargs
+
+LBFGS_LR, ADAM_LR = 0.5, 0.02
+ADAM_KWARGS = dict(betas=(0.9, 0.999))
+
+
+
+def autocast_settings(optimizer, amp):
+    """Whether to autocast, and to which dtype, when optimizing with the given optimizer.
+
+    BF16 is used on GPUs that support it, it has FP32's range so the tiny loss gradients don't need scaling. Otherwise
+    first-order optimizers use FP16 with gradient scaling, while LBFGS (which GradScaler doesn't support) runs in full
+    precision.
+    """
+    if amp and torch.cuda.is_bf16_supported():
+        return True, torch.bfloat16
+    if amp and "LBFGS" not in optimizer:
+        return True, torch.float16
+    return False, None
+
+
+def fp16_loss_scale(target_embeddings, n_content):
+    """Initial FP16 gradient scale, sized so content feature gradients don't underflow.
+
+    feature_loss normalizes its gradient to an L1 norm of ~1 and then divides by numel, so each element of a content
+    feature's gradient is ~1/N^2. Unscaled that is far below FP16's smallest subnormal (6e-8) and becomes zero.
+    """
+    n = max([target_embeddings[i].numel() for i in range(n_content)], default=1)
+    return 2.0 ** (2 * math.ceil(math.log2(n)) - 8)  # brings 1/N^2 up to ~2^-8
 
 
-@torch.no_grad()
 def transfer(
     content_img: Union[Tensor, Image.Image, str],
     style_imgs: List[Union[Tensor, Image.Image, str]],
@@ -30,14 +60,16 @@ def transfer(
     parameterization="rgb",
     perceptor="kbc-vgg19",
     perceptor_kwargs={},
-    optimizer="LBFGS",
-    lr=0.5,
+    optimizer=None,
+    lr=None,
     optimizer_kwargs={},
     n_iters=512,
     content_weight=1,
     style_weight=50,
     tv_weight=100,
     style_scale=1,
+    amp=True,
+    perceptor_dtype=None,
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
 ):
     """Perform a neural style transfer
@@ -52,14 +84,16 @@ def transfer(
         parameterization (str, optional): How to parameterize the image. Choices ["rgb", "vqgan"]
         perceptor (str, optional): Which perceptor to optimize with. Choices ["kbc-vgg19", "pgg-vgg19", "pgg-vgg16", "pgg-prune", "pgg-nyud", "pgg-fcn32s", "pgg-sod", "pgg-nin"].
         perceptor_kwargs (dict, optional): Key word arguments for the Perceptor class.
-        optimizer (str, optional): Optimizer to use. For choices see optimizers.py
-        lr (float, optional): Optimizer learning rate.
+        optimizer (str, optional): Optimizer to use. For choices see optimizers.py. "LBFGS+Adam" runs LBFGS for the first third of iterations and Adam for the rest. Defaults to LBFGS up to 1024px and Adam above that. Adam's learning rate follows a cosine schedule.
+        lr (float, optional): Optimizer learning rate. Defaults to None which uses 0.5 for LBFGS and 0.02 for other optimizers. In the "LBFGS+Adam" schedule this only sets the LBFGS learning rate.
         optimizer_kwargs (dict, optional): Key word arguments for the optimizer.
         n_iters (int, optional): Number of iterations to optimize for.
         content_weight (int, optional): Strength of content preserving loss. Higher values will lead to outputs which better preserve the content's structure and texture.
         style_weight (int, optional): Strength of style loss. Higher values will lead to outputs which look more like the style images.
         tv_weight (int, optional): Strength of total variation loss. Higher values lead to smoother outputs.
         style_scale (int, optional): Scale of style images relative to output image. Larger scales will make textures from styles larger in the output image.
+        amp (bool, optional): Run the perceptor in mixed precision on CUDA devices. Uses BF16 where the GPU supports it. Otherwise uses FP16 with gradient scaling for first-order optimizers and full precision for LBFGS.
+        perceptor_dtype (torch.dtype, optional): Cast the perceptor's weights to this dtype (e.g. torch.float16) once, instead of autocasting every iteration. Disables amp. Ignored on CPU, and for BF16 on GPUs without BF16 support. FP16 with LBFGS uses a fixed loss scale, BF16 needs none.
         content_layers (List[int], optional): Layers in Perceptor network that the content loss will be calculated for. Defaults to None which uses defaults defined in each Perceptor class.
         style_layers (List[int], optional): Layers in Perceptor network that the style loss will be calculated for. Defaults to None which uses defaults defined in each Perceptor class.
         device (torch.device, optional): Device to run on.
@@ -67,54 +101,142 @@ def transfer(
     Returns:
         Tensor: Result image
     """
-    content_img, style_imgs, init_img = load_images(content_img, style_imgs, init_img)
+    device = torch.device(device)
+    if perceptor_dtype is not None and device.type != "cuda":
+        warnings.warn(f"Reduced precision perceptors are only supported on CUDA, ignoring {perceptor_dtype}")
+        perceptor_dtype = None
+    if perceptor_dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        warnings.warn("This GPU doesn't support BF16, ignoring perceptor_dtype=torch.bfloat16")
+        perceptor_dtype = None
+    amp = amp and device.type == "cuda" and perceptor_dtype is None  # casting the weights once replaces autocast
+
+    if optimizer is None:
+        optimizer = "LBFGS" if size <= 1024 else "Adam"  # LBFGS history no longer fits in memory at large sizes
+    if lr is None:
+        lr = LBFGS_LR if "LBFGS" in optimizer else ADAM_LR
+    if optimizer == "LBFGS+Adam":
+        phases = [
+            ("LBFGS", n_iters // 3, lr, optimizer_kwargs),
+            ("Adam", n_iters - n_iters // 3, ADAM_LR, ADAM_KWARGS),
+        ]
+    elif optimizer == "Adam" and optimizer_kwargs == {}:
+        phases = [("Adam", n_iters, lr, ADAM_KWARGS)]
+    else:
+        phases = [(optimizer, n_iters, lr, optimizer_kwargs)]
+
+    with torch.inference_mode():
+        content_img, style_imgs, init_img = load_images(content_img, style_imgs, init_img)
+
+        content_img = resample(content_img.to(device), size)
+        style_imgs = [resample(im.to(device), size * style_scale) for im in style_imgs]
+        content_img = match_histogram(content_img, style_imgs, mode=match_hist)
 
-    content_img = resample(content_img.to(device), size)
-    style_imgs = [resample(im.to(device), size * style_scale) for im in style_imgs]
-    content_img = match_histogram(content_img, style_imgs, mode=match_hist)
+        # NHWC lets cuDNN pick its tensor core convolution kernels without transposing
+        content_img = content_img.contiguous(memory_format=torch.channels_last)
+        style_imgs = [im.contiguous(memory_format=torch.channels_last) for im in style_imgs]
 
+    # created outside inference mode, the weights are needed for the backward pass
+    perceptor = load_perceptor(perceptor)(
+        content_strength=content_weight, style_strength=style_weight, **perceptor_kwargs
+    ).to(device, memory_format=torch.channels_last)
+    if perceptor_dtype is not None:
+        perceptor = perceptor.to(perceptor_dtype)
+
+    embedding_amp, embedding_dtype = autocast_settings(phases[0][0], amp)
+    if embedding_amp and embedding_dtype == torch.float16:
+        # Gram matrices sum over every pixel, scale them down so they can be stored in FP16
+        perceptor.gram_norm = content_img.shape[-2] * content_img.shape[-1]
+    with torch.inference_mode():
+        if perceptor_dtype is not None:
+            style_imgs = [im.to(perceptor_dtype) for im in style_imgs]
+        with torch.autocast(device.type, dtype=embedding_dtype) if embedding_amp else nullcontext():
+            target_embeddings = perceptor.get_target_embeddings(
+                content_img if perceptor_dtype is None else content_img.to(perceptor_dtype), style_imgs
+            )
+        if embedding_amp:
+            # targets live for the whole optimization, store them at the autocast precision if they fit
+            stored = target_embeddings.to(embedding_dtype)
+            if all(stored[i].isfinite().all() for i in range(len(stored))):
+                target_embeddings = stored
+            else:
+                warnings.warn(f"Target embeddings overflow {embedding_dtype}, storing them in full precision")
+            del stored
+    del style_imgs
+
+    # inference tensors can't take part in autograd, so everything that does is copied out of inference mode once
+    target_embeddings = target_embeddings.clone()
+    loss_scale = fp16_loss_scale(target_embeddings, len(perceptor.content_layers))
+
+    # pastiche is allocated only after the perceptor's intermediate activations have been released
     if init_img is not None:
-        init_tensor = init_img
+        init_tensor = init_img.clone()
     elif init_type == "content":
-        init_tensor = content_img
+        init_tensor = content_img.clone()
     elif init_type == "random":
         init_tensor = None
 
     pastiche = load_parameterization(parameterization)(
         content_img.shape[2], content_img.shape[3], tensor=init_tensor
-    ).to(device)
+    ).to(device, memory_format=torch.channels_last)
 
-    perceptor = load_perceptor(perceptor)(
-        content_strength=content_weight, style_strength=style_weight, **perceptor_kwargs
-    ).to(device)
-    target_embeddings = perceptor.get_target_embeddings(content_img, style_imgs)
+    del content_img, init_img, init_tensor
 
-    del content_img, style_imgs
+    # flush the allocator exactly once at the setup/optimization boundary, never inside closure(): emptying the cache
+    # is slow and leaves the GPU idle while every later iteration has to re-reserve the same blocks
     gc.collect()
-    torch.cuda.empty_cache()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.synchronize(device)
 
     with torch.enable_grad(), tqdm(total=n_iters, desc=f"Optimizing @ {size}px") as pbar:
 
-        opt, niter = load_optimizer(optimizer, lr, optimizer_kwargs, n_iters, pastiche.parameters())
-
         def closure():
-            opt.zero_grad()
+            opt.zero_grad(set_to_none=True)
             pastiche.update_ema()
 
-            img = pastiche()
+            with torch.autocast(device.type, dtype=amp_dtype) if phase_amp else nullcontext():
+                img = pastiche().contiguous(memory_format=torch.channels_last)  # no-op for channels_last parameters
+                if perceptor_dtype is not None:
+                    img = img.to(perceptor_dtype)
 
-            loss = perceptor.get_loss(img, target_embeddings)
-            if tv_weight > 0:
-                loss += tv_weight * tv_loss(img)
+                loss = perceptor.get_loss(img, target_embeddings, tv_weight).float()
 
-            loss.backward()
+            if static_scale:
+                # LBFGS can't use GradScaler, so a fixed scale is applied here and divided back out of the gradients
+                (loss * loss_scale).backward()
+                for p in pastiche.parameters():
+                    if p.grad is not None:
+                        p.grad.div_(loss_scale)
+            else:
+                scaler.scale(loss).backward()
             pbar.update()
             return loss
 
-        for _ in range(niter):
-            opt.step(closure)
+        for phase_optimizer, phase_iters, phase_lr, phase_kwargs in phases:
+            phase_amp, amp_dtype = autocast_settings(phase_optimizer, amp)
+            fp16 = amp_dtype == torch.float16 or perceptor_dtype == torch.float16
+            scale_grads = fp16 and "LBFGS" not in phase_optimizer  # GradScaler doesn't support LBFGS closures
+            static_scale = fp16 and "LBFGS" in phase_optimizer
+
+            opt, niter = load_optimizer(phase_optimizer, phase_lr, phase_kwargs, phase_iters, pastiche.parameters())
+            scaler = torch.cuda.amp.GradScaler(init_scale=loss_scale, enabled=scale_grads)
+            # Adam anneals to zero over its phase so the pastiche settles instead of jittering at a constant step size
+            schedule = torch.optim.lr_scheduler.CosineAnnealingLR(opt, niter) if phase_optimizer == "Adam" else None
+
+            for _ in range(niter):
+                if scale_grads:
+                    closure()
+                    scaler.step(opt)
+                    scaler.update()
+                else:
+                    opt.step(closure)
+                if schedule is not None:
+                    schedule.step()
 
-    return pastiche.decode_average()
+            del opt, scaler, schedule
+
+    with torch.no_grad():
+        return pastiche.decode_average()
 
 
 def argument_parser():
@@ -131,35 +253,32 @@ def argument_parser():
     parser.add_argument("--parameterization", default="rgb", choices=["rgb", "vqgan"])
     parser.add_argument("--perceptor", default="kbc-vgg19", choices=["kbc-vgg19" ,"pgg-vgg19", "pgg-vgg16", "pgg-prune", "pgg-nyud", "pgg-fcn32s", "pgg-sod", "pgg-nin"])
     parser.add_argument("--perceptor_kwargs", nargs="*", default=[])
-    parser.add_argument("--optimizer", default="LBFGS", choices=OPTIMIZERS)
-    parser.add_argument("--lr", type=float, default=0.5)
+    parser.add_argument("--optimizer", default=None, choices=OPTIMIZERS + ["LBFGS+Adam"])
+    parser.add_argument("--lr", type=float, default=None, help="Defaults to 0.5 for LBFGS and 0.02 for other optimizers")
     parser.add_argument("--optimizer_kwargs", nargs="*", default=[])
     parser.add_argument("--n_iters", type=int, default=512)
     parser.add_argument("--content_weight", type=float, default=1)
     parser.add_argument("--style_weight", type=float, default=50)
     parser.add_argument("--tv_weight", type=float, default=100)
     parser.add_argument("--style_scale", type=float, default=1)
+    parser.add_argument("--expandable_segments", action="store_true", help="Use expandable CUDA allocator segments to reduce fragmentation from repeated allocations in the optimization loop (PyTorch 2.1+)")
+    parser.add_argument("--no_amp", action="store_true", help="Disable mixed precision (AMP reduces memory usage and increases speed on tensor cores)")
+    model_dtype = parser.add_mutually_exclusive_group()
+    model_dtype.add_argument("--fp16_model", action="store_true", help="Cast perceptor weights to FP16 once instead of autocasting every iteration")
+    model_dtype.add_argument("--bf16_model", action="store_true", help="Cast perceptor weights to BF16 once instead of autocasting every iteration")
     parser.add_argument("--device", default=torch.device("cuda" if torch.cuda.is_available() else "cpu"))
     # fmt: on
     return parser
 
 
 def main(args):
-    if len(args.perceptor_kwargs) > 0:
-        perceptor_kwargs = {
-            k: eval(t)(v)
-            for k, t, v in zip(args.perceptor_kwargs[::3], args.perceptor_kwargs[1::3], args.perceptor_kwargs[2::3])
-        }
-    else:
-        perceptor_kwargs = {}
+    if args.expandable_segments:
+        enable_expandable_segments()
+    torch.backends.cuda.matmul.allow_tf32 = True  # FP32 Gram matrices and convolutions run on tensor cores
+    torch.backends.cudnn.allow_tf32 = True
 
-    if len(args.optimizer_kwargs) > 0:
-        optimizer_kwargs = {
-            k: eval(t)(v)
-            for k, t, v in zip(args.optimizer_kwargs[::3], args.optimizer_kwargs[1::3], args.optimizer_kwargs[2::3])
-        }
-    else:
-        optimizer_kwargs = {}
+    perceptor_kwargs = parse_kwargs(args.perceptor_kwargs)
+    optimizer_kwargs = parse_kwargs(args.optimizer_kwargs)
 
     img = transfer(
         content_img=args.content,
@@ -179,6 +298,8 @@ def main(args):
         style_weight=args.style_weight,
         tv_weight=args.tv_weight,
         style_scale=args.style_scale,
+        amp=not args.no_amp,
+        perceptor_dtype=torch.float16 if args.fp16_model else torch.bfloat16 if args.bf16_model else None,
         device=args.device,
     )
     tensor2img(img).save(f"output/{'_'.join([Path(arg).stem for arg in [args.content] + args.styles])}.png")
@@ -23,6 +23,8 @@ from maua.ops.video import write_video
 from maua.optimizers import load_optimizer, OPTIMIZERS
 from maua.parameterizations import load_parameterization
 from maua.perceptors import load_perceptor
+from maua.utility import parse_kwargs
+
 
 
 def scaled_height_width(h, w, size):
@@ -353,21 +355,8 @@ def argument_parser():
 
 
 def main(args):
-    if len(args.perceptor_kwargs) > 0:
-        perceptor_kwargs = {
-            k: eval(t)(v)
-            for k, t, v in zip(args.perceptor_kwargs[::3], args.perceptor_kwargs[1::3], args.perceptor_kwargs[2::3])
-        }
-    else:
-        perceptor_kwargs = {}
-
-    if len(args.optimizer_kwargs) > 0:
-        optimizer_kwargs = {
-            k: eval(t)(v)
-            for k, t, v in zip(args.optimizer_kwargs[::3], args.optimizer_kwargs[1::3], args.optimizer_kwargs[2::3])
-        }
-    else:
-        optimizer_kwargs = {}
+    perceptor_kwargs = parse_kwargs(args.perceptor_kwargs)
+    optimizer_kwargs = parse_kwargs(args.optimizer_kwargs)
 
     output_name = args.out_dir + "/" + "_".join([Path(v).stem for v in [args.content] + args.styles]) + ".mp4"
     video = transfer(
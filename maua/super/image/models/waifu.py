@@ -98,17 +98,18 @@ def split(img: torch.Tensor, scale: int, pad_size: int, seg_size: int):
     img = nn.functional.pad(img, [pad_size] * 4, mode="replicate")
     _, _, height, width = img.size()
     ys, xs = windowed_index(img.device, height, width, scale, pad_size, seg_size)
-    patch_box = img[:, :, ys, xs].squeeze().permute(1, 0, 2, 3)
+    patch_box = img[:, :, ys, xs].transpose(1, 2).flatten(0, 1)  # [B, C, N, h, w] -> [B * N, C, h, w]
     return patch_box, height, width
 
 
 def merge(img: torch.Tensor, height: int, width: int, scale: int, pad_size: int, seg_size: int):
     ys, xs = windowed_index(img.device, height * scale, width * scale, scale, pad_size * scale, seg_size * scale)
     rem = pad_size * 2
-    img = img[..., rem:-rem, rem:-rem].permute(1, 0, 2, 3).unsqueeze(0).float()
+    img = img[..., rem:-rem, rem:-rem]
+    img = img.reshape(-1, len(ys), *img.shape[1:]).transpose(1, 2).float()  # [B * N, C, h, w] -> [B, C, N, h, w]
     ys = ys[..., rem:-rem, rem:-rem]
     xs = xs[..., rem:-rem, rem:-rem]
-    out = torch.zeros((1, 3, height * scale, width * scale), device=img.device)
+    out = torch.zeros((len(img), 3, height * scale, width * scale), device=img.device)
     out[:, :, ys, xs] = img
     return out[..., rem:-rem, rem:-rem]
 
@@ -120,4 +121,4 @@ def upscale(images, model, scale=4, pad_size=3, seg_size=64, batch_size=256):
             img_patches, h, w = split(img, 2, pad_size, seg_size)
             larger_patches = torch.cat([model(patches) for patches in torch.split(img_patches, batch_size)])
             img = merge(larger_patches, h, w, 2, pad_size, seg_size).clamp(0, 1)
-        yield img.cpu().float()
+        yield img.float()
@@ -34,6 +34,8 @@ MODEL_MODULES = {
     "RealSR": bsrgan,
 }
 MODEL_NAMES = list(MODEL_MODULES.keys())
+# models whose upscale() accepts [B, C, H, W] batches, the others process one image per call
+BATCHED_MODELS = [name for name, module in MODEL_MODULES.items() if module in (bsrgan, swinir, waifu)]
 
 
 def upscale(
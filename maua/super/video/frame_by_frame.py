@@ -1,32 +1,177 @@
 import argparse
 import os
 from pathlib import Path
+from queue import Full, Queue
+from threading import Event, Thread
 
 import numpy as np
 import torch
-from decord import VideoReader
+from decord import DECORDError, VideoReader, gpu
+from torch.utils.dlpack import from_dlpack
 from tqdm import tqdm
 
 from maua.ops.video import VideoWriter
 from maua.super.image import MODEL_NAMES
+from maua.super.image.single import BATCHED_MODELS
 from maua.super.image import upscale as upscale_images
+from maua.utility import enable_expandable_segments
 
 
-def upscale(video_file, model_name, device, out_dir):
-    vr = VideoReader(video_file)
+def open_video(video_file, device):
+    """Open a VideoReader which decodes with NVDEC directly into GPU memory when possible"""
+    device = torch.device(device)
+    if device.type == "cuda":
+        try:
+            return VideoReader(video_file, ctx=gpu(device.index or 0)), True
+        except DECORDError:  # decord built without CUDA support
+            pass
+    return VideoReader(video_file, num_threads=4), False
+
+
+def prefetch_frames(vr, device, batch_size=8, queue_size=8, gpu_decoded=False, chunk_size=64):
+    """Decode [B, C, H, W] batches of frames on a background thread, on CUDA the next batch uploads during processing"""
+    device = torch.device(device)
+    h, w, _ = vr[0].shape
+    batches, stop = Queue(maxsize=queue_size), Event()
+
+    def put(item):
+        # bounded waits so the thread notices when the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def decode():
+        try:
+            # large get_batch reads let decord seek GOP-aware, independent of how many frames are uploaded at once
+            for i in range(0, len(vr), chunk_size):
+                chunk = from_dlpack(vr.get_batch(list(range(i, min(i + chunk_size, len(vr))))).to_dlpack())
+                for batch in torch.split(chunk, batch_size):
+                    if not put(batch):
+                        return
+        except Exception as e:
+            put(e)  # re-raised on the consuming thread
+        finally:
+            put(None)
+
+    def decoded():
+        for batch in iter(batches.get, None):
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+    Thread(target=decode, daemon=True).start()
+
+    try:
+        if device.type != "cuda" or gpu_decoded:
+            for batch in decoded():
+                yield batch.permute(0, 3, 1, 2).float().div_(255)
+            return
+
+        stream, current = torch.cuda.Stream(device), torch.cuda.current_stream(device)
+        staging = [torch.empty((batch_size, h, w, 3), dtype=torch.uint8).pin_memory() for _ in range(2)]
+        uploaded = [torch.cuda.Event(), torch.cuda.Event()]
+
+        pending, k = None, 0
+        for batch in decoded():
+            n = len(batch)
+            uploaded[k].synchronize()  # previous copy out of this staging buffer has finished
+            staging[k][:n].copy_(batch)
+            with torch.cuda.stream(stream):
+                tensor = staging[k][:n].to(device, non_blocking=True).permute(0, 3, 1, 2).float().div_(255)
+                uploaded[k].record(stream)
+
+            if pending is not None:
+                yield pending
+            current.wait_event(uploaded[k])
+            tensor.record_stream(current)
+            pending, k = tensor, 1 - k
+
+        if pending is not None:
+            yield pending
+    finally:
+        stop.set()  # also when the consumer raised or closed the generator early
+
+
+def write_frames(video, batches, progress=None, ring_size=4):
+    """Write batches of frames to video on a background thread, CUDA frames go through a pinned host ring buffer"""
+    pending, free = Queue(maxsize=ring_size), Queue()
+    ring, copied, errors = None, None, []
+
+    def write():
+        for frame, event, slot in iter(pending.get, None):
+            try:
+                if event is not None:
+                    event.synchronize()
+                if not errors:  # keep draining after a failure so the producer never blocks
+                    video.write(frame)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if slot is not None:
+                    free.put(slot)
+
+    writer = Thread(target=write, daemon=True)
+    writer.start()
+
+    try:
+        for batch in batches:
+            if not batch.is_cuda:
+                for frame in batch.split(1):
+                    pending.put((frame, None, None))
+            else:
+                # quantize on device so only a quarter of the bytes are copied
+                batch = batch.clamp(0, 1).mul(255).round().byte()
+
+                if ring is None:
+                    ring = [torch.empty(batch[:1].shape, dtype=torch.uint8).pin_memory() for _ in range(ring_size)]
+                    copied = [torch.cuda.Event() for _ in range(ring_size)]
+                    for slot in range(ring_size):
+                        free.put(slot)
+
+                for frame in batch.split(1):
+                    slot = free.get()  # blocks until the writer has released a host buffer
+                    ring[slot].copy_(frame, non_blocking=True)
+                    copied[slot].record(torch.cuda.current_stream(frame.device))
+                    pending.put((ring[slot], copied[slot], slot))
+
+            if progress is not None:
+                progress.update(len(batch))
+    finally:
+        pending.put(None)  # always stop the writer, also when upscaling or decoding raised
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def upscale(video_file, model_name, device, out_dir, batch_size=8):
+    vr, gpu_decoded = open_video(video_file, device)
     fps = vr.get_avg_fps()
     h, w, _ = vr[0].shape
 
     out_file = f"{out_dir}/{Path(video_file).stem}_{model_name}.mp4"
     with VideoWriter(output_file=out_file, output_size=(4 * w, 4 * h), fps=fps) as video:
-        frames = (torch.from_numpy(vr[i].asnumpy()).permute(2, 0, 1).unsqueeze(0).div(255) for i in range(len(vr)))
-        for frame in tqdm(upscale_images(frames, model_name, device), total=len(vr)):
-            video.write(frame)
+        frames = prefetch_frames(vr, device, batch_size, gpu_decoded=gpu_decoded)
+        try:
+            batches = frames
+            if model_name not in BATCHED_MODELS:  # RealESRGAN and latent diffusion upscale one image at a time
+                batches = (frame for batch in frames for frame in batch.split(1))
+            # the CUDA cache is deliberately not emptied between batches, every batch reuses the same blocks
+            with tqdm(total=len(vr)) as progress:
+                write_frames(video, upscale_images(batches, model_name, device), progress)
+        finally:
+            frames.close()  # stops the decode thread if upscaling or writing raised
 
-    return VideoReader(out_file)
+    return out_file
 
 
 def main(args):
+    if args.expandable_segments:
+        enable_expandable_segments()
+
     for video_file in args.video_files:
 
         out_file = f"{args.out_dir}/{Path(video_file).stem}_{args.model_name}.mp4"
@@ -34,7 +179,7 @@ def main(args):
             print(f"Skipping {Path(video_file).stem}, output {Path(out_file).stem} already exists!")
             continue
 
-        upscale(video_file, args.model_name, args.device, args.out_dir)
+        upscale(video_file, args.model_name, args.device, args.out_dir, args.batch_size)
 
 
 def argument_parser():
@@ -43,4 +188,15 @@ def argument_parser():
     parser.add_argument("--model_name", default="latent-diffusion", choices=MODEL_NAMES)
     parser.add_argument("--device", default="cuda:0")
     parser.add_argument("--out_dir", default="output/")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Frames decoded, uploaded and upscaled at once (SwinIR, BSRGAN, RealSR and waifu2x take whole batches)",
+    )
+    parser.add_argument(
+        "--expandable_segments",
+        action="store_true",
+        help="Use expandable CUDA allocator segments to reduce fragmentation from per-frame allocations (PyTorch 2.1+)",
+    )
     return parser
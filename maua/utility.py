@@ -1,8 +1,10 @@
 import os
 import urllib.request
+import warnings
 from pathlib import Path
 
 import requests
+import torch
 from tqdm import tqdm
 
 
@@ -71,3 +73,28 @@ def fetch(path_or_url):
     if not (path_or_url.startswith("http://") or path_or_url.startswith("https://")):
         return open(path_or_url, "rb")
     return requests.get(path_or_url, stream=True).raw
+
+
+def enable_expandable_segments():
+    """Let the CUDA caching allocator grow segments in place, must be called before the first CUDA allocation"""
+    version = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+    if version < (2, 1):
+        warnings.warn(f"Expandable segments require PyTorch 2.1 or newer (found {torch.__version__}), ignoring.")
+        return
+    conf = os.environ.get("PYTORCH_CUDA_ALLOC_CONF", "")
+    if "expandable_segments" not in conf:
+        os.environ["PYTORCH_CUDA_ALLOC_CONF"] = ",".join(filter(None, [conf, "expandable_segments:True"]))
+
+
+# type names accepted in --perceptor_kwargs / --optimizer_kwargs triples (name type value)
+KWARG_TYPES = {"int": int, "float": float, "str": str, "bool": lambda v: v.lower() == "true"}
+
+
+def parse_kwargs(triples):
+    """Parse a flat [name, type, value, ...] command line list into a dict of keyword arguments"""
+    kwargs = {}
+    for k, t, v in zip(triples[::3], triples[1::3], triples[2::3]):
+        if t not in KWARG_TYPES:
+            raise Exception(f"Type {t} of keyword argument {k} not recognized! Choices are: {list(KWARG_TYPES.keys())}")
+        kwargs[k] = KWARG_TYPES[t](v)
+    return kwargs